@@ -417,7 +417,9 @@ def collate_wrapper_criteo_length(list_of_tuples):
     return X_int, lS_l, lS_i, T
 
 
-def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
+def make_criteo_data_and_loaders(
+    args, offset_to_length_converter=False, pin_memory=True, prefetch_factor=2
+):
     if args.mlperf_logging and args.memory_map and args.data_set == "terabyte":
         # more efficient for larger batches
         data_directory = path.dirname(args.raw_data_file)
@@ -452,7 +454,7 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                 shuffle=False,
                 num_workers=0,
                 collate_fn=None,
-                pin_memory=True,
+                pin_memory=pin_memory,
                 drop_last=False,
                 sampler=RandomSampler(train_data) if args.mlperf_bin_shuffle else None
             )
@@ -474,7 +476,7 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                 shuffle=False,
                 num_workers=0,
                 collate_fn=None,
-                pin_memory=True,
+                pin_memory=pin_memory,
                 drop_last=False,
             )
         else:
@@ -550,14 +552,25 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
         if offset_to_length_converter:
             collate_wrapper_criteo = collate_wrapper_criteo_length
 
+        # keep the worker processes (and their copies of the dataset) alive
+        # across epochs, instead of respawning them for every epoch
+        def worker_kwargs(num_workers):
+            if num_workers > 0:
+                return {
+                    "persistent_workers": True,
+                    "prefetch_factor": prefetch_factor,
+                }
+            return {}
+
         train_loader = torch.utils.data.DataLoader(
             train_data,
             batch_size=args.mini_batch_size,
             shuffle=False,
             num_workers=args.num_workers,
             collate_fn=collate_wrapper_criteo,
-            pin_memory=True,
+            pin_memory=pin_memory,
             drop_last=False,  # True
+            **worker_kwargs(args.num_workers),
         )
 
         test_loader = torch.utils.data.DataLoader(
@@ -566,8 +579,9 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
             shuffle=False,
             num_workers=args.test_num_workers,
             collate_fn=collate_wrapper_criteo,
-            pin_memory=True,
+            pin_memory=pin_memory,
             drop_last=False,  # True
+            **worker_kwargs(args.test_num_workers),
         )
 
     return train_data, train_loader, test_data, test_loader
@@ -718,7 +732,7 @@ def collate_wrapper_random_length(list_of_tuples):
 
 
 def make_random_data_and_loader(args, ln_emb, m_den,
-    offset_to_length_converter=False, cache_size=None,
+    offset_to_length_converter=False, cache_size=None, pin_memory=True,
 ):
 
     train_data = RandomDataset(
@@ -777,7 +791,7 @@ def make_random_data_and_loader(args, ln_emb, m_den,
         shuffle=False,
         num_workers=args.num_workers,
         collate_fn=collate_wrapper_random,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=False,  # True
     )
 
@@ -787,7 +801,7 @@ def make_random_data_and_loader(args, ln_emb, m_den,
         shuffle=False,
         num_workers=args.num_workers,
         collate_fn=collate_wrapper_random,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=False,  # True
     )
     return train_data, train_loader, test_data, test_loader
@@ -67,8 +67,9 @@ import argparse
 
 # miscellaneous
 import builtins
-import datetime
+import concurrent.futures
 import json
+import re
 import sys
 import time
 import itertools
@@ -133,6 +134,26 @@ except (ImportError, OSError):
     torch2trt_import_error_msg = traceback.format_exc()
     torch2trt = None
 
+try:
+    import torchao
+    from torchao.quantization import quantize_
+    try:
+        from torchao.quantization import (
+            Int8WeightOnlyConfig,
+            Int8DynamicActivationInt8WeightConfig,
+            Float8DynamicActivationFloat8WeightConfig,
+        )
+    except ImportError:
+        # releases before the config classes only have the function-style names
+        from torchao.quantization import (
+            int8_weight_only as Int8WeightOnlyConfig,
+            int8_dynamic_activation_int8_weight as Int8DynamicActivationInt8WeightConfig,
+            float8_dynamic_activation_float8_weight as Float8DynamicActivationFloat8WeightConfig,
+        )
+except (ImportError, OSError):
+    torchao_import_error_msg = traceback.format_exc()
+    torchao = None
+
 # mixed-dimension trick
 from tricks.md_embedding_bag import PrEmbeddingBag, md_solver
 
@@ -174,27 +195,30 @@ def dlrm_wrap(X, lS_o, lS_i, use_gpu, device, ndevices=1):
         if use_gpu:
             # lS_i can be either a list of tensors or a stacked tensor.
             # Handle each case below:
+            # (the copies are queued on the current stream without blocking the
+            # host; they are asynchronous when the batch is in pinned memory)
             if ndevices == 1:
                 lS_i = (
-                    [S_i.to(device) for S_i in lS_i]
+                    [S_i.to(device, non_blocking=True) for S_i in lS_i]
                     if isinstance(lS_i, list)
-                    else lS_i.to(device)
+                    else lS_i.to(device, non_blocking=True)
                 )
                 lS_o = (
-                    [S_o.to(device) for S_o in lS_o]
+                    [S_o.to(device, non_blocking=True) for S_o in lS_o]
                     if isinstance(lS_o, list)
-                    else lS_o.to(device)
+                    else lS_o.to(device, non_blocking=True)
                 )
-        return dlrm(X.to(device), lS_o, lS_i)
+        return dlrm(X.to(device, non_blocking=True), lS_o, lS_i)
 
 
 def loss_fn_wrap(Z, T, use_gpu, device):
     with record_function("DLRM loss compute"):
         if args.loss_function == "mse" or args.loss_function == "bce":
-            return dlrm.loss_fn(Z, T.to(device))
+            return dlrm.loss_fn(Z, T.to(device, non_blocking=True))
         elif args.loss_function == "wbce":
-            loss_ws_ = dlrm.loss_ws[T.data.view(-1).long()].view_as(T).to(device)
-            loss_fn_ = dlrm.loss_fn(Z, T.to(device))
+            T = T.to(device, non_blocking=True)
+            loss_ws_ = dlrm.loss_ws.index_select(0, T.view(-1).long()).view_as(T)
+            loss_fn_ = dlrm.loss_fn(Z, T)
             loss_sc_ = loss_ws_ * loss_fn_
             return loss_sc_.mean()
 
@@ -203,7 +227,105 @@ def loss_fn_wrap(Z, T, use_gpu, device):
 # loop below.
 def unpack_batch(b):
     # Experiment with unweighted samples
-    return b[0], b[1], b[2], b[3], torch.ones(b[3].size()), None
+    # (sample weights of None stand for all ones and are not allocated)
+    return b[0], b[1], b[2], b[3], None, None
+
+
+# Copies the tensors of a (nested) checkpoint to the host, so that it can be
+# serialized in the background while training keeps updating the originals.
+def stage_checkpoint(obj):
+    if torch.is_tensor(obj):
+        if obj.is_cuda and obj.layout == torch.strided:
+            # (pinned destinations let the copies queue up without a sync per
+            # tensor, the caller synchronizes once after staging)
+            staged = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return staged.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        staged = type(obj)((k, stage_checkpoint(v)) for k, v in obj.items())
+        # (state dicts carry their module versions in _metadata)
+        if hasattr(obj, "_metadata"):
+            staged._metadata = obj._metadata
+        return staged
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(stage_checkpoint(v) for v in obj)
+    return obj
+
+
+# Param groups of the distributed model: the (model parallel) embeddings of this
+# rank, and the (data parallel) bottom and top mlps.
+def build_param_groups(dlrm, lr, use_fbgemm_gpu):
+    if use_fbgemm_gpu:
+        embs = [e.fbgemm_gpu_emb_bag for e in dlrm.fbgemm_emb_l]
+    elif dlrm.quantize_bits != 32:
+        embs = dlrm.emb_l_q
+    else:
+        embs = dlrm.emb_l
+    return [
+        {
+            "params": list(
+                itertools.chain.from_iterable(emb.parameters() for emb in embs)
+            ),
+            "lr": lr,
+        },
+        # (both mlps are wrapped in DDP, which averages their gradients over the
+        # ranks, so they take the same lr as the single process run)
+        {"params": dlrm.bot_l.parameters(), "lr": lr},
+        {"params": dlrm.top_l.parameters(), "lr": lr},
+    ]
+
+
+# Iterates over the batches of a loader, copying the next batch to the gpu on a
+# side stream while the current one is processed. The batches must be in pinned
+# memory (DataLoader pin_memory) for the copies to be asynchronous. At most
+# nbatches batches are yielded (all if nbatches <= 0), and the batches for which
+# skip(i, batch) is true are yielded as they are, without being copied.
+class DLRMPrefetcher:
+    def __init__(self, loader, device, nbatches=-1, skip=None):
+        self.loader = loader
+        self.device = device
+        self.nbatches = nbatches
+        self.skip = skip
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        i = 0
+        next_batch = self.preload(it, i)
+        while next_batch is not None:
+            batch, copied = next_batch
+            if copied:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                # the batch was allocated on the side stream, but is consumed on
+                # the current one
+                self.apply(lambda t: t.record_stream(current_stream), batch)
+            i += 1
+            next_batch = self.preload(it, i)
+            yield batch
+
+    def preload(self, it, i):
+        if self.nbatches > 0 and i >= self.nbatches:
+            return None
+        try:
+            b = next(it)
+        except StopIteration:
+            return None
+        if self.skip is not None and self.skip(i, b):
+            return b, False
+        with torch.cuda.stream(self.stream):
+            return self.apply(lambda t: t.to(self.device, non_blocking=True), b), True
+
+    # applies f to the tensors of a (nested lists or tuples) batch
+    def apply(self, f, b):
+        if isinstance(b, torch.Tensor):
+            return f(b)
+        if isinstance(b, (list, tuple)):
+            return type(b)(self.apply(f, t) for t in b)
+        return b
 
 
 class LRPolicyScheduler(_LRScheduler):
@@ -216,31 +338,49 @@ class LRPolicyScheduler(_LRScheduler):
         if self.decay_start_step < self.num_warmup_steps:
             sys.exit("Learning rate warmup must finish before the decay starts")
 
+        # precompute the lr of every param group for each step of the schedule,
+        # so get_lr is a single table lookup
+        # (needed before the base class __init__, which calls get_lr)
+        base_lrs = np.asarray(
+            [group.get("initial_lr", group["lr"]) for group in optimizer.param_groups],
+            dtype=np.float64,
+        )
+        self.lr_table = self.create_lr_table(base_lrs)
+
         super(LRPolicyScheduler, self).__init__(optimizer)
 
+    def create_lr_table(self, base_lrs):
+        # the lr is constant from the last row of the table onwards
+        steps = np.arange(max(self.num_warmup_steps, self.decay_end_step) + 1)
+        lr_table = np.empty((steps.size, base_lrs.size))
+
+        # warmup
+        warmup = steps < self.num_warmup_steps
+        scale = 1.0 - (self.num_warmup_steps - steps[warmup]) / self.num_warmup_steps
+        lr_table[warmup] = base_lrs * scale[:, np.newaxis]
+
+        # decay
+        decay = (self.decay_start_step <= steps) & (steps < self.decay_end_step)
+        decay &= ~warmup
+        decayed_steps = steps[decay] - self.decay_start_step
+        scale = ((self.num_decay_steps - decayed_steps) / self.num_decay_steps) ** 2
+        min_lr = 0.0000001
+        lr_table[decay] = np.maximum(min_lr, base_lrs * scale[:, np.newaxis])
+
+        # do not adjust
+        frozen = ~(warmup | decay)
+        lr_table[frozen] = base_lrs
+        if self.num_decay_steps > 0:
+            # freeze at last, either because we're after decay
+            # or because we're between warmup and decay
+            last = np.maximum.accumulate(np.where(frozen, -1, steps))
+            frozen &= last >= 0
+            lr_table[frozen] = lr_table[last[frozen]]
+        return lr_table
+
     def get_lr(self):
-        step_count = self._step_count
-        if step_count < self.num_warmup_steps:
-            # warmup
-            scale = 1.0 - (self.num_warmup_steps - step_count) / self.num_warmup_steps
-            lr = [base_lr * scale for base_lr in self.base_lrs]
-            self.last_lr = lr
-        elif self.decay_start_step <= step_count and step_count < self.decay_end_step:
-            # decay
-            decayed_steps = step_count - self.decay_start_step
-            scale = ((self.num_decay_steps - decayed_steps) / self.num_decay_steps) ** 2
-            min_lr = 0.0000001
-            lr = [max(min_lr, base_lr * scale) for base_lr in self.base_lrs]
-            self.last_lr = lr
-        else:
-            if self.num_decay_steps > 0:
-                # freeze at last, either because we're after decay
-                # or because we're between warmup and decay
-                lr = self.last_lr
-            else:
-                # do not adjust
-                lr = self.base_lrs
-        return lr
+        step_count = min(self._step_count, len(self.lr_table) - 1)
+        return self.lr_table[step_count].tolist()
 
 
 # quantize_fbgemm_gpu_embedding_bag is partially lifted from
@@ -274,7 +414,7 @@ def quantize_fbgemm_gpu_embedding_bag(model, quantize_type, device):
         if weight_ty == SparseType.FP16:
             original_weight = model.split_embedding_weights()[t]
             q_weight = original_weight.half()
-            weights = torch.tensor(q_weight.cpu().numpy().view(np.uint8))
+            weights = q_weight.contiguous().view(torch.uint8)
             q_model.split_embedding_weights()[t][0].data.copy_(weights)
 
         elif weight_ty == SparseType.INT8:
@@ -283,14 +423,13 @@ def quantize_fbgemm_gpu_embedding_bag(model, quantize_type, device):
                 original_weight
             )
             weights = q_weight[:, :-8]
-            scale_shift = torch.tensor(
+            # reinterpret the fp32 scale/shift as fp16 bytes on the device
+            scale_shift = (
                 q_weight[:, -8:]
                 .contiguous()
-                .cpu()
-                .numpy()
-                .view(np.float32)
-                .astype(np.float16)
-                .view(np.uint8)
+                .view(torch.float32)
+                .to(torch.float16)
+                .view(torch.uint8)
             )
             q_model.split_embedding_weights()[t][0].data.copy_(weights)
             q_model.split_embedding_weights()[t][1].data.copy_(scale_shift)
@@ -302,14 +441,121 @@ def quantize_fbgemm_gpu_embedding_bag(model, quantize_type, device):
                 bit_rate=quantize_type.bit_rate(),
             )
             weights = q_weight[:, :-4]
-            scale_shift = torch.tensor(
-                q_weight[:, -4:].contiguous().cpu().numpy().view(np.uint8)
+            scale_shift = q_weight[:, -4:].contiguous().view(torch.uint8)
+            q_model.split_embedding_weights()[t][0].data.copy_(weights)
+            q_model.split_embedding_weights()[t][1].data.copy_(scale_shift)
+    return q_model
+
+
+# Builds an IntNBitTableBatchedEmbeddingBagsCodegen directly from tables that are
+# already row-wise quantized (by embedding_bag_byte_prepack,
+# embedding_bag_4bit_prepack or embedding_bag_2bit_prepack), copying the quantized rows and their scale/shift
+# instead of dequantizing them to FP32 and quantizing them again.
+def create_fbgemm_gpu_intn_emb_bag_from_quantized(emb_l, Ds, quantize_type, device):
+    embedding_specs = []
+    if device.type == "cpu":
+        emb_location = split_table_batched_embeddings_ops.EmbeddingLocation.HOST
+    else:
+        emb_location = split_table_batched_embeddings_ops.EmbeddingLocation.DEVICE
+
+    for (e, D) in zip(emb_l, Ds):
+        weights_ty = quantize_type
+        if D % weights_ty.align_size() != 0:
+            assert D % 4 == 0
+            weights_ty = (
+                SparseType.FP16
+            )  # fall back to FP16 if dimension couldn't be aligned with the required size
+        embedding_specs.append(("", e.shape[0], D, weights_ty, emb_location))
+
+    q_model = (
+        split_table_batched_embeddings_ops.IntNBitTableBatchedEmbeddingBagsCodegen(
+            embedding_specs=embedding_specs,
+            pooling_mode=PoolingMode.SUM,
+            device=device,
+        )
+    )
+    q_model.initialize_weights()
+    for t, (_, _, _, weight_ty, _) in enumerate(embedding_specs):
+        q_weight = emb_l[t].to(device)
+        if weight_ty == SparseType.FP16:
+            if quantize_type == SparseType.INT8:
+                original_weight = torch.ops.fbgemm.Fused8BitRowwiseQuantizedToFloat(
+                    q_weight
+                )
+            else:
+                original_weight = (
+                    torch.ops.fbgemm.FusedNBitRowwiseQuantizedSBHalfToFloat(
+                        q_weight,
+                        bit_rate=quantize_type.bit_rate(),
+                    )
+                )
+            weights = original_weight.half().contiguous().view(torch.uint8)
+            q_model.split_embedding_weights()[t][0].data.copy_(weights)
+
+        elif weight_ty == SparseType.INT8:
+            # fp32 scale/shift of the prepacked rows are stored as fp16 by IntN
+            weights = q_weight[:, :-8]
+            scale_shift = (
+                q_weight[:, -8:]
+                .contiguous()
+                .view(torch.float32)
+                .to(torch.float16)
+                .view(torch.uint8)
             )
             q_model.split_embedding_weights()[t][0].data.copy_(weights)
             q_model.split_embedding_weights()[t][1].data.copy_(scale_shift)
+
+        elif weight_ty == SparseType.INT4 or weight_ty == SparseType.INT2:
+            weights = q_weight[:, :-4]
+            scale_shift = q_weight[:, -4:]
+            q_model.split_embedding_weights()[t][0].data.copy_(weights)
+            q_model.split_embedding_weights()[t][1].data.copy_(scale_shift)
     return q_model
 
 
+# Fills the flat weights buffer of a Split TBE with the tables of emb_l, laid
+# out back to back. Host tables are moved to the device a chunk at a time through
+# two small pinned buffers (one is refilled while the other is being copied), so
+# no pinned copy of all the tables is made.
+def copy_tables_to_flat_weights(flat_weights, emb_l, staging_numel=1 << 24):
+    flat_weights = flat_weights.detach()
+    offset = 0
+    if flat_weights.device.type == "cpu":
+        for e in emb_l:
+            n = e.numel()
+            flat_weights[offset : offset + n].copy_(e.detach().reshape(-1))
+            offset += n
+        return
+    chunk = min(staging_numel, flat_weights.numel())
+    staging = [
+        torch.empty(chunk, dtype=flat_weights.dtype, pin_memory=True)
+        for _ in range(2)
+    ]
+    copied = [None, None]
+    b = 0
+    with torch.cuda.device(flat_weights.device):
+        for e in emb_l:
+            src = e.detach().reshape(-1)
+            if src.device.type != "cpu":
+                flat_weights[offset : offset + src.numel()].copy_(src)
+                offset += src.numel()
+                continue
+            for start in range(0, src.numel(), chunk):
+                piece = src[start : start + chunk]
+                n = piece.numel()
+                # (wait until the previous copy out of this buffer is done)
+                if copied[b] is not None:
+                    copied[b].synchronize()
+                buf = staging[b][:n]
+                buf.copy_(piece)
+                flat_weights[offset : offset + n].copy_(buf, non_blocking=True)
+                copied[b] = torch.cuda.Event()
+                copied[b].record()
+                offset += n
+                b = 1 - b
+        torch.cuda.synchronize()
+
+
 def create_fbgemm_gpu_emb_bag(
     device,
     emb_l,
@@ -340,12 +586,14 @@ def create_fbgemm_gpu_emb_bag(
     cache_algorithm = CacheAlgorithm.LRU
 
     sparse_type_dict = {
+        2: SparseType.INT2,
         4: SparseType.INT4,
         8: SparseType.INT8,
         16: SparseType.FP16,
         32: SparseType.FP32,
     }
     codegen_type_dict = {
+        2: "IntN",
         4: "IntN",
         8: "Split" if codegen_preference != "IntN" else "IntN",
         16: "Split" if codegen_preference != "IntN" else "IntN",
@@ -354,7 +602,16 @@ def create_fbgemm_gpu_emb_bag(
 
     codegen_type = codegen_type_dict[quantize_bits]
     quantize_type = sparse_type_dict[quantize_bits]
-    if codegen_type == "IntN":
+    if codegen_type == "IntN" and quantize_type in [
+        SparseType.INT8,
+        SparseType.INT4,
+        SparseType.INT2,
+    ]:
+        # emb_l holds row-wise quantized tables, so reuse their bytes as is
+        fbgemm_gpu_emb_bag = create_fbgemm_gpu_intn_emb_bag_from_quantized(
+            emb_l, Ds, quantize_type, device
+        )
+    elif codegen_type == "IntN":
         # Create non-quantized model and then call quantize_fbgemm_gpu_embedding_bag
         fbgemm_gpu_emb_bag = SplitTableBatchedEmbeddingBagsCodegen(
             embedding_specs=[
@@ -372,26 +629,9 @@ def create_fbgemm_gpu_emb_bag(
             cache_algorithm=cache_algorithm,
             pooling_mode=pooling_mode,
         ).to(device)
-        if quantize_type == quantize_type.FP16:
-            weights = fbgemm_gpu_emb_bag.split_embedding_weights()
-            for i, emb in enumerate(weights):
-                emb.data.copy_(emb_l[i])
-
-        elif quantize_type == quantize_type.INT8:
-            # copy quantized values upsampled/recasted to FP32
-            for i in range(len(Es)):
-                fbgemm_gpu_emb_bag.split_embedding_weights()[i].data.copy_(
-                    torch.ops.fbgemm.Fused8BitRowwiseQuantizedToFloat(emb_l[i])
-                )
-        elif quantize_type == quantize_type.INT4:
-            # copy quantized values upsampled/recasted to FP32
-            for i in range(len(Es)):
-                fbgemm_gpu_emb_bag.split_embedding_weights()[i].data.copy_(
-                    torch.ops.fbgemm.FusedNBitRowwiseQuantizedSBHalfToFloat(
-                        emb_l[i],
-                        bit_rate=quantize_type.bit_rate(),
-                    )
-                )
+        weights = fbgemm_gpu_emb_bag.split_embedding_weights()
+        for i, emb in enumerate(weights):
+            emb.data.copy_(emb_l[i])
         fbgemm_gpu_emb_bag = quantize_fbgemm_gpu_embedding_bag(
             fbgemm_gpu_emb_bag, quantize_type, device
         )
@@ -413,9 +653,18 @@ def create_fbgemm_gpu_emb_bag(
             pooling_mode=pooling_mode,
         ).to(device)
 
+        # The tables are laid out back to back in a single buffer, so fill it
+        # in large pinned chunks instead of one copy per table when the sizes agree.
         weights = fbgemm_gpu_emb_bag.split_embedding_weights()
-        for i, emb in enumerate(weights):
-            emb.data.copy_(emb_l[i])
+        if device.type == "cpu":
+            flat_weights = fbgemm_gpu_emb_bag.weights_host
+        else:
+            flat_weights = fbgemm_gpu_emb_bag.weights_dev
+        if flat_weights.numel() == sum(w.numel() for w in weights):
+            copy_tables_to_flat_weights(flat_weights, emb_l)
+        else:
+            for i, emb in enumerate(weights):
+                emb.data.copy_(emb_l[i])
 
     if not requires_grad:
         torch.no_grad()
@@ -424,6 +673,32 @@ def create_fbgemm_gpu_emb_bag(
     return fbgemm_gpu_emb_bag
 
 
+# Gathers the fixed per sample weights of the indices of all tables, laid out
+# back to back (lengths[k] of them for table k), with a single index_select over
+# the concatenated weight vectors of the tables, each table's indices shifted by
+# the number of rows in the preceding tables. The concatenation and the row
+# offsets are kept in cache, a dict owned by the caller, and are rebuilt whenever
+# v_W_l holds different tensors (e.g. after they were moved to another device).
+def gather_fixed_per_sample_weights(v_W_l, indices, lengths, cache):
+    cached_W_l = cache.get("v_W_l")
+    if (
+        cached_W_l is None
+        or len(cached_W_l) != len(v_W_l)
+        or any(a is not b for a, b in zip(cached_W_l, v_W_l))
+    ):
+        sizes = [w.numel() for w in v_W_l]
+        cache["v_W_l"] = list(v_W_l)
+        cache["v_W_cat"] = torch.cat(list(v_W_l))
+        cache["row_offsets"] = torch.cumsum(
+            torch.tensor([0] + sizes[:-1], dtype=torch.long, device=v_W_l[0].device),
+            dim=0,
+        )
+    row_offsets = torch.repeat_interleave(
+        cache["row_offsets"], lengths, output_size=indices.numel()
+    )
+    return cache["v_W_cat"].index_select(0, indices + row_offsets)
+
+
 # The purpose of this wrapper is to encapsulate the format conversions to/from fbgemm_gpu
 # so parallel_apply() executes the format-in -> fbgemm_gpu op -> format-out instructions
 # for each respective GPU in parallel.
@@ -450,9 +725,18 @@ class fbgemm_gpu_emb_bag_wrapper(nn.Module):
         )
         self.device = device
         self.m_spa = m_spa
-        # create cumsum array for mixed dimension support
+        # IntN ops take int32 indices and offsets
+        if isinstance(self.fbgemm_gpu_emb_bag, IntNBitTableBatchedEmbeddingBagsCodegen):
+            self.index_dtype = torch.int32
+        else:
+            self.index_dtype = torch.long
+        # concatenated fixed per sample weights, see gather_fixed_per_sample_weights
+        self.v_W_cache = {}
+        # buffer that lists of offsets are stacked into, reused across batches
+        self.lS_o_buf = None
+        # create split sizes for mixed dimension support
         if isinstance(m_spa, list):
-            self.m_spa_cumsum = np.cumsum([0] + m_spa)
+            self.m_spa_split_sizes = tuple(int(d) for d in m_spa)
         if not requires_grad:
             torch.no_grad()
             torch.set_grad_enabled(False)
@@ -460,35 +744,71 @@ class fbgemm_gpu_emb_bag_wrapper(nn.Module):
     def forward(self, lS_o, lS_i, v_W_l=None):
 
         # convert offsets to fbgemm format
-        lengths_list = list(map(len, lS_i))
-        indices_lengths_cumsum = np.cumsum([0] + lengths_list)
-        if isinstance(lS_o, list):
-            lS_o = torch.stack(lS_o)
-        lS_o = lS_o.to(self.device)
-        lS_o += torch.from_numpy(indices_lengths_cumsum[:-1, np.newaxis]).to(
-            self.device
+        # (the prefix sum of the indices lengths is computed on the device, so no
+        # per-batch numpy cumsum and H2D copy is needed)
+        if isinstance(lS_i, torch.Tensor):
+            # stacked indices: every table has the same number of indices
+            split_sizes = [lS_i.size(1)] * lS_i.size(0)
+            lengths = torch.full(
+                (lS_i.size(0),), lS_i.size(1), dtype=torch.long, device=self.device
+            )
+        else:
+            split_sizes = [S_i.numel() for S_i in lS_i]
+            lengths = torch.tensor(split_sizes, dtype=torch.long, device=self.device)
+        indices_lengths_cumsum = torch.cumsum(
+            torch.nn.functional.pad(lengths, (1, 0)), dim=0
         )
-        numel = torch.tensor([indices_lengths_cumsum[-1]], dtype=torch.long).to(
-            self.device
+        if isinstance(lS_o, list):
+            # stack into the buffer of the previous batch if the shape is unchanged
+            S_o = lS_o[0]
+            if (
+                self.lS_o_buf is None
+                or self.lS_o_buf.shape != (len(lS_o),) + S_o.shape
+                or self.lS_o_buf.dtype != S_o.dtype
+                or self.lS_o_buf.device != S_o.device
+            ):
+                self.lS_o_buf = torch.empty(
+                    (len(lS_o),) + S_o.shape, dtype=S_o.dtype, device=S_o.device
+                )
+            lS_o = torch.stack(lS_o, out=self.lS_o_buf)
+        # shift each table's offsets by the preceding tables' lengths and append
+        # the total number of indices, building the final offsets in one cat
+        lS_o = torch.cat(
+            (
+                (lS_o.to(self.device) + indices_lengths_cumsum[:-1, None]).view(-1),
+                indices_lengths_cumsum[-1:],
+            )
         )
-        lS_o = torch.cat((lS_o.flatten(), numel))
+
+        # convert indices to fbgemm_gpu format
+        # (stacked indices are flattened without a cat, and the cast to the
+        # index dtype is done by the same call as the device transfer)
+        if isinstance(lS_i, torch.Tensor):
+            lS_i = lS_i.reshape(-1)
+        else:
+            lS_i = torch.cat(lS_i, dim=0)
+        lS_i = lS_i.to(self.device, dtype=self.index_dtype)
 
         # create per_sample_weights
-        if v_W_l:
+        if v_W_l and any(w.requires_grad for w in v_W_l):
+            # learned weights are gathered per table, concatenating them would
+            # copy every row of every table in each batch
             per_sample_weights = torch.cat(
-                [a.gather(0, b) for a, b in zip(v_W_l, lS_i)]
+                [
+                    w.index_select(0, S_i)
+                    for w, S_i in zip(v_W_l, torch.split(lS_i, split_sizes))
+                ]
+            )
+        elif v_W_l:
+            # fixed weights are gathered from all tables at once
+            per_sample_weights = gather_fixed_per_sample_weights(
+                v_W_l, lS_i, lengths, self.v_W_cache
             )
         else:
             per_sample_weights = None
 
-        # convert indices to fbgemm_gpu format
-        if isinstance(lS_i, torch.Tensor):
-            lS_i = [lS_i]
-        lS_i = torch.cat(lS_i, dim=0).to(self.device)
-
-        if isinstance(self.fbgemm_gpu_emb_bag, IntNBitTableBatchedEmbeddingBagsCodegen):
+        if self.index_dtype == torch.int32:
             lS_o = lS_o.int()
-            lS_i = lS_i.int()
 
         # gpu embedding bag op
         ly = self.fbgemm_gpu_emb_bag(lS_i, lS_o, per_sample_weights)
@@ -496,19 +816,23 @@ class fbgemm_gpu_emb_bag_wrapper(nn.Module):
         # convert the results to the next layer's input format.
         if isinstance(self.m_spa, list):
             # handle mixed dimensions case.
-            ly = [
-                ly[:, s:e]
-                for (s, e) in zip(self.m_spa_cumsum[:-1], self.m_spa_cumsum[1:])
-            ]
+            ly = list(torch.split(ly, self.m_spa_split_sizes, dim=1))
         else:
             # handle case in which all tables share the same column dimension.
             cols = self.m_spa
             ntables = len(self.fbgemm_gpu_emb_bag.embedding_specs)
-            ly = ly.reshape(-1, ntables, cols).swapaxes(0, 1)
-            ly = list(ly)
+            ly = list(torch.unbind(ly.view(-1, ntables, cols).transpose(0, 1), dim=0))
         return ly
 
 
+# Computes only the unique (lower triangular) pairwise dot products of the rows
+# of T, given their row indices li and lj. Under torch.compile the two gathers,
+# the product and the sum are fused into one reduction kernel, so neither the
+# full bmm output nor the gathered rows are written to memory.
+def dot_interaction_tril(T, li, lj):
+    return (T.index_select(1, li) * T.index_select(1, lj)).sum(dim=2)
+
+
 ### define dlrm in PyTorch ###
 class DLRM_Net(nn.Module):
     def create_mlp(self, ln, sigmoid_layer):
@@ -523,24 +847,19 @@ class DLRM_Net(nn.Module):
             LL = nn.Linear(int(n), int(m), bias=True)
 
             # initialize the weights
-            # with torch.no_grad():
             # custom Xavier input, output or two-sided fill
+            # (drawn with numpy, so the values match dlrm_s_caffe2.py, and copied
+            # in place into the existing parameters)
             mean = 0.0  # std_dev = np.sqrt(variance)
             std_dev = np.sqrt(2 / (m + n))  # np.sqrt(1 / m) # np.sqrt(1 / n)
             W = np.random.normal(mean, std_dev, size=(m, n)).astype(np.float32)
             std_dev = np.sqrt(1 / m)  # np.sqrt(2 / (m + 1))
             bt = np.random.normal(mean, std_dev, size=m).astype(np.float32)
-            # approach 1
-            LL.weight.data = torch.tensor(W)
+            with torch.no_grad():
+                LL.weight.copy_(torch.from_numpy(W))
+                LL.bias.copy_(torch.from_numpy(bt))
             LL.weight.requires_grad = self.requires_grad
-            LL.bias.data = torch.tensor(bt)
             LL.bias.requires_grad = self.requires_grad
-            # approach 2
-            # LL.weight.data.copy_(torch.tensor(W))
-            # LL.bias.data.copy_(torch.tensor(bt))
-            # approach 3
-            # LL.weight = Parameter(torch.tensor(W),requires_grad=True)
-            # LL.bias = Parameter(torch.tensor(bt),requires_grad=True)
             layers.append(LL)
 
             # construct sigmoid or relu operator
@@ -602,20 +921,18 @@ class DLRM_Net(nn.Module):
                 W = np.random.uniform(
                     low=-np.sqrt(1 / n), high=np.sqrt(1 / n), size=(n, _m)
                 ).astype(np.float32)
-                EE.embs.weight.data = torch.tensor(W, requires_grad=self.requires_grad)
+                with torch.no_grad():
+                    EE.embs.weight.copy_(torch.from_numpy(W))
             else:
                 EE = nn.EmbeddingBag(n, m, mode="sum", sparse=True)
                 # initialize embeddings
-                # nn.init.uniform_(EE.weight, a=-np.sqrt(1 / n), b=np.sqrt(1 / n))
+                # (drawn with numpy, so the values match dlrm_s_caffe2.py, and
+                # copied in place instead of allocating a new tensor for the table)
                 W = np.random.uniform(
                     low=-np.sqrt(1 / n), high=np.sqrt(1 / n), size=(n, m)
                 ).astype(np.float32)
-                # approach 1
-                EE.weight.data = torch.tensor(W, requires_grad=self.requires_grad)
-                # approach 2
-                # EE.weight.data.copy_(torch.tensor(W))
-                # approach 3
-                # EE.weight = Parameter(torch.tensor(W),requires_grad=True)
+                with torch.no_grad():
+                    EE.weight.copy_(torch.from_numpy(W))
             if weighted_pooling is None:
                 v_W_l.append(None)
             else:
@@ -654,6 +971,8 @@ class DLRM_Net(nn.Module):
         quantize_emb_with_bit=False,
         use_torch2trt_for_mlp=False,
         use_tf32=False,
+        use_torch_compile_for_interaction=False,
+        unit_pooling=False,
     ):
         super(DLRM_Net, self).__init__()
 
@@ -711,12 +1030,22 @@ class DLRM_Net(nn.Module):
                 )
                 self.local_emb_slice = ext_dist.get_my_slice(n_emb)
                 self.local_emb_indices = list(range(n_emb))[self.local_emb_slice]
+                # side stream on which the embedding alltoall is issued (created
+                # on first use in distributed_forward)
+                self.comm_stream = None
 
             # create operators
             self.emb_l, self.v_W_l = self.create_emb(m_spa, ln_emb, weighted_pooling)
             if self.weighted_pooling == "learned":
                 self.v_W_l = nn.ParameterList(list(map(Parameter, self.v_W_l)))
 
+            # with one index per lookup, the sum pooling of a plain EmbeddingBag
+            # is a row gather, which is done without the bag reduction
+            # (the offsets of these tables are then ignored, also in the onnx export)
+            self.unit_pooling_l = [
+                unit_pooling and type(E) is nn.EmbeddingBag for E in self.emb_l
+            ]
+
             self.bot_l = self.create_mlp(ln_bot, sigmoid_bot)
             self.top_l = self.create_mlp(ln_top, sigmoid_top)
 
@@ -741,8 +1070,20 @@ class DLRM_Net(nn.Module):
             # fbgemm_gpu
             self.fbgemm_emb_l = []
             self.v_W_l_l = [self.v_W_l] if self.weighted_pooling else [None]
-
-            self.interact_features_l = []
+            # concatenated fixed pooling weights, see gather_fixed_per_sample_weights
+            self.v_W_cache = {}
+            # (device, position) of each table's output, per number of devices
+            self.fbgemm_interleave = {}
+
+            self.table_devices = []
+            # lower triangular interaction indices, per device
+            self.interaction_indices = {}
+            if use_torch_compile_for_interaction:
+                self.dot_interaction_tril = torch.compile(
+                    dot_interaction_tril, dynamic=False
+                )
+            else:
+                self.dot_interaction_tril = None
 
             # specify the loss function
             if self.loss_function == "mse":
@@ -751,7 +1092,7 @@ class DLRM_Net(nn.Module):
                 self.loss_fn = torch.nn.BCELoss(reduction="mean")
             elif self.loss_function == "wbce":
                 self.loss_ws = torch.tensor(
-                    np.fromstring(args.loss_weights, dtype=float, sep="-")
+                    np.asarray(args.loss_weights.split("-"), dtype=float)
                 )
                 self.loss_fn = torch.nn.BCELoss(reduction="none")
             else:
@@ -766,14 +1107,15 @@ class DLRM_Net(nn.Module):
         self.top_l_replicas = replicate(self.top_l, device_ids)
 
         # distribute embeddings (model parallelism)
+        devices = [torch.device("cuda", k) for k in range(ndevices)]
+        # device of each table, reused when distributing the sparse features
+        self.table_devices = [devices[k % ndevices] for k in range(self.ntables)]
         if self.weighted_pooling is not None:
             for k, w in enumerate(self.v_W_l):
-                self.v_W_l[k] = Parameter(
-                    w.to(torch.device("cuda:" + str(k % ndevices)))
-                )
+                self.v_W_l[k] = Parameter(w.to(devices[k % ndevices]))
         if not self.use_fbgemm_gpu:
             for k, w in enumerate(self.emb_l):
-                self.emb_l[k] = w.to(torch.device("cuda:" + str(k % ndevices)))
+                self.emb_l[k] = w.to(devices[k % ndevices])
         else:
             self.fbgemm_emb_l, self.v_W_l_l = zip(
                 *[
@@ -796,16 +1138,38 @@ class DLRM_Net(nn.Module):
                     for k in range(ndevices)
                 ]
             )
+            # parameters created here, which the training loop adds to the
+            # optimizer as a separate param group
+            self.lazy_params = []
+            if self.weighted_pooling == "learned":
+                self.lazy_params += [p for p_l in self.v_W_l_l for p in p_l]
+            self.lazy_params += [
+                emb
+                for emb_ in self.fbgemm_emb_l
+                for emb in emb_.fbgemm_gpu_emb_bag.parameters()
+            ]
             self.add_new_weights_to_params = True
-        self.interact_features_l = [self.nn_module_wrapper() for _ in range(ndevices)]
 
-    # nn_module_wrapper is used to call functions concurrently across multi-gpus, using parallel_apply,
-    # which requires an nn.Module subclass.
-    class nn_module_wrapper(nn.Module):
-        def __init__(self):
-            super(DLRM_Net.nn_module_wrapper, self).__init__()
-        def forward(self, E, x, ly):
-            return E(x, ly)
+    def scatter_sparse_features(self, lS, ndevices):
+        # distribute the per-table inputs lS across devices, table k going to
+        # device k % ndevices (model parallelism). The inputs of all tables placed
+        # on a device are staged in one pinned host buffer and copied with a single
+        # non-blocking transfer, which is then split back into per-table views.
+        if lS[0].is_cuda:
+            return [
+                lS[k].to(self.table_devices[k], non_blocking=True)
+                for k in range(self.ntables)
+            ]
+        lS_d = [None] * self.ntables
+        for d in range(ndevices):
+            tables = range(d, self.ntables, ndevices)
+            sizes = [lS[k].numel() for k in tables]
+            buf = torch.empty(sum(sizes), dtype=lS[d].dtype, pin_memory=True)
+            torch.cat([lS[k].reshape(-1) for k in tables], out=buf)
+            buf = buf.to(self.table_devices[d], non_blocking=True)
+            for k, S in zip(tables, buf.split(sizes)):
+                lS_d[k] = S.view(lS[k].shape)
+        return lS_d
 
     def apply_mlp(self, x, layers):
         # approach 1: use ModuleList
@@ -815,6 +1179,20 @@ class DLRM_Net(nn.Module):
         # approach 2: use Sequential container to wrap all layers
         return layers(x)
 
+    def gather_per_sample_weights(self, lS_i):
+        # gather the fixed pooling weights of the indices of all tables at once,
+        # instead of one gather per table, and split them back per table
+        if isinstance(lS_i, list):
+            split_sizes = [S_i.numel() for S_i in lS_i]
+            indices = torch.cat(lS_i)
+        else:
+            split_sizes = [lS_i.size(1)] * lS_i.size(0)
+            indices = lS_i.reshape(-1)
+        lengths = torch.tensor(split_sizes, dtype=torch.long, device=indices.device)
+        return gather_fixed_per_sample_weights(
+            self.v_W_l, indices, lengths, self.v_W_cache
+        ).split(split_sizes)
+
     def apply_emb(self, lS_o, lS_i):
         # WARNING: notice that we are processing the batch at once. We implicitly
         # assume that the data is laid out such that:
@@ -833,8 +1211,30 @@ class DLRM_Net(nn.Module):
                 self.fbgemm_emb_l, list(zip(lS_o_l, lS_i_l, self.v_W_l_l))
             )
             # Interleave and flatten to match non-fbgemm_gpu ly format.
-            ly = [ly[i % ndevices][i // ndevices] for i in range(self.ntables)]
+            interleave = self.fbgemm_interleave.get(ndevices)
+            if interleave is None:
+                interleave = [(i % ndevices, i // ndevices) for i in range(self.ntables)]
+                self.fbgemm_interleave[ndevices] = interleave
+            ly = [ly[d][j] for d, j in interleave]
         else:
+            # Tables are looked up one at a time here; the fused single-kernel
+            # lookup over all tables is the fbgemm_gpu path above.
+            # Resolve the quantized lookup op once rather than for every table.
+            if self.quantize_emb:
+                if self.quantize_bits == 2:
+                    QE = ops.quantized.embedding_bag_2bit_rowwise_offsets
+                elif self.quantize_bits == 4:
+                    QE = ops.quantized.embedding_bag_4bit_rowwise_offsets
+                elif self.quantize_bits == 8:
+                    QE = ops.quantized.embedding_bag_byte_rowwise_offsets
+
+            # When all tables live on one device, fixed pooling weights of all
+            # tables are gathered at once. (learned weights are gathered per
+            # table, concatenating them would copy every row in each batch)
+            psw_l = None
+            if self.weighted_pooling == "fixed" and self.ndevices_available <= 1:
+                psw_l = self.gather_per_sample_weights(lS_i)
+
             ly = []
             for k, sparse_index_group_batch in enumerate(lS_i):
                 sparse_offset_group_batch = lS_o[k]
@@ -845,7 +1245,9 @@ class DLRM_Net(nn.Module):
                 # happening vertically across 0 axis, resulting in a row vector
                 # E = emb_l[k]
 
-                if self.v_W_l[k] is not None:
+                if psw_l is not None:
+                    per_sample_weights = psw_l[k]
+                elif self.v_W_l[k] is not None:
                     per_sample_weights = self.v_W_l[k].gather(
                         0, sparse_index_group_batch
                     )
@@ -853,11 +1255,7 @@ class DLRM_Net(nn.Module):
                     per_sample_weights = None
 
                 if self.quantize_emb:
-                    if self.quantize_bits == 4:
-                        E = ops.quantized.embedding_bag_4bit_rowwise_offsets
-                    elif self.quantize_bits == 8:
-                        E = ops.quantized.embedding_bag_byte_rowwise_offsets
-                    QV = E(
+                    QV = QE(
                         self.emb_l_q[k],
                         sparse_index_group_batch,
                         sparse_offset_group_batch,
@@ -865,6 +1263,16 @@ class DLRM_Net(nn.Module):
                     )
 
                     ly.append(QV)
+                elif self.unit_pooling_l[k]:
+                    # every bag holds a single index, so offsets are not needed
+                    E = self.emb_l[k]
+                    V = nn.functional.embedding(
+                        sparse_index_group_batch, E.weight, sparse=E.sparse
+                    )
+                    if per_sample_weights is not None:
+                        V = V * per_sample_weights.unsqueeze(1)
+
+                    ly.append(V)
                 else:
                     E = self.emb_l[k]
                     V = E(
@@ -883,19 +1291,43 @@ class DLRM_Net(nn.Module):
 
         n = len(self.emb_l)
         self.emb_l_q = [None] * n
-        for k in range(n):
-            if bits == 4:
-                self.emb_l_q[k] = ops.quantized.embedding_bag_4bit_prepack(
-                    self.emb_l[k].weight
-                )
-            elif bits == 8:
-                self.emb_l_q[k] = ops.quantized.embedding_bag_byte_prepack(
-                    self.emb_l[k].weight
-                )
-            elif bits == 16:
+        if bits in [2, 4, 8]:
+            prepack = {
+                2: ops.quantized.embedding_bag_2bit_prepack,
+                4: ops.quantized.embedding_bag_4bit_prepack,
+                8: ops.quantized.embedding_bag_byte_prepack,
+            }[bits]
+            # The prepack quantizes each row independently, so the tables of equal
+            # dimension are stacked and prepacked with a single call, and the
+            # result is split back into per-table (row range) views.
+            # (the prepack parallelizes over the rows with the intra-op thread
+            # pool, so the call already uses all cores set by torch.set_num_threads)
+            groups = {}
+            for k in range(n):
+                groups.setdefault(self.emb_l[k].weight.shape[1], []).append(k)
+            with torch.no_grad():
+                for tables in groups.values():
+                    W = [self.emb_l[k].weight for k in tables]
+                    rows = [w.shape[0] for w in W]
+                    if len(W) > 1:
+                        # copy each table into its slice of the stacked tensor and
+                        # point the table at that slice, releasing its own storage,
+                        # so at most one extra table is resident while stacking
+                        W_cat = W[0].new_empty((sum(rows), W[0].shape[1]))
+                        for w, w_slice in zip(W, W_cat.split(rows)):
+                            w_slice.copy_(w)
+                            w.data = w_slice
+                    else:
+                        W_cat = W[0]
+                    W_q = prepack(W_cat)
+                    del W, W_cat
+                    for k, w_q in zip(tables, W_q.split(rows)):
+                        self.emb_l_q[k] = w_q
+        elif bits == 16:
+            for k in range(n):
                 self.emb_l_q[k] = self.emb_l[k].half().weight
-            else:
-                return
+        else:
+            return
         self.emb_l = None
         self.quantize_emb = True
         self.quantize_bits = bits
@@ -903,27 +1335,43 @@ class DLRM_Net(nn.Module):
     def interact_features(self, x, ly):
 
         if self.arch_interaction_op == "dot":
-            # concatenate dense and sparse features
+            # stack dense and sparse features into a (batch_size, n + 1, d) tensor
             (batch_size, d) = x.shape
-            T = torch.cat([x] + ly, dim=1).view((batch_size, -1, d))
+            T = torch.stack([x] + ly, dim=1)
             # perform a dot product
             if self.proj_size > 0:
                 R = project.project(T, x, self.proj_l)
             else:
-                Z = torch.bmm(T, torch.transpose(T, 1, 2))
-                # append dense feature with the interactions (into a row vector)
-                # approach 1: all
-                # Zflat = Z.view((batch_size, -1))
-                # approach 2: unique
-                _, ni, nj = Z.shape
                 # approach 1: tril_indices
                 # offset = 0 if self.arch_interaction_itself else -1
                 # li, lj = torch.tril_indices(ni, nj, offset=offset)
                 # approach 2: custom
-                offset = 1 if self.arch_interaction_itself else 0
-                li = torch.tensor([i for i in range(ni) for j in range(i + offset)])
-                lj = torch.tensor([j for i in range(nj) for j in range(i + offset)])
-                Zflat = Z[:, li, lj]
+                # (built once per device and reused)
+                ni = nj = T.shape[1]
+                indices = self.interaction_indices.get(T.device)
+                if indices is None:
+                    offset = 1 if self.arch_interaction_itself else 0
+                    li = torch.tensor(
+                        [i for i in range(ni) for j in range(i + offset)],
+                        device=T.device,
+                    )
+                    lj = torch.tensor(
+                        [j for i in range(nj) for j in range(i + offset)],
+                        device=T.device,
+                    )
+                    indices = (li, lj, li * nj + lj)
+                    self.interaction_indices[T.device] = indices
+                li, lj, lij = indices
+                if self.dot_interaction_tril is not None:
+                    # only the unique dot products, fused into a single kernel
+                    Zflat = self.dot_interaction_tril(T, li, lj)
+                else:
+                    Z = torch.bmm(T, torch.transpose(T, 1, 2))
+                    # append dense feature with the interactions (into a row vector)
+                    # approach 1: all
+                    # Zflat = Z.view((batch_size, -1))
+                    # approach 2: unique
+                    Zflat = Z.view((batch_size, -1)).index_select(1, lij)
                 # concatenate dense features and interactions
                 R = torch.cat([x] + [Zflat], dim=1)
         elif self.arch_interaction_op == "cat":
@@ -984,13 +1432,31 @@ class DLRM_Net(nn.Module):
         if self.ntables != len(ly):
             sys.exit("ERROR: corrupted intermediate result in distributed_forward call")
 
-        a2a_req = ext_dist.alltoall(ly, self.n_emb_per_rank)
+        # issue the alltoall on a side stream, so that it overlaps with the
+        # bottom mlp kernels enqueued on the current stream below
+        comm_stream = None
+        if ly[0].is_cuda:
+            if self.comm_stream is None:
+                self.comm_stream = torch.cuda.Stream(device=ly[0].device)
+            comm_stream = self.comm_stream
+            comm_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(comm_stream):
+                a2a_req = ext_dist.alltoall(ly, self.n_emb_per_rank)
+        else:
+            a2a_req = ext_dist.alltoall(ly, self.n_emb_per_rank)
 
         with record_function("DLRM bottom mlp forward"):
             x = self.apply_mlp(dense_x, self.bot_l)
 
+        if comm_stream is not None:
+            torch.cuda.current_stream().wait_stream(comm_stream)
         ly = a2a_req.wait()
         ly = list(ly)
+        if comm_stream is not None:
+            # the output was allocated on the side stream, but is consumed on
+            # the current one
+            for y in ly:
+                y.record_stream(torch.cuda.current_stream())
 
         # interactions
         with record_function("DLRM interaction forward"):
@@ -1067,14 +1533,8 @@ class DLRM_Net(nn.Module):
         if (self.ntables != len(lS_o)) or (self.ntables != len(lS_i)):
             sys.exit("ERROR: corrupted model input detected in parallel_forward call")
 
-        lS_o = [
-            lS_o[k].to(torch.device("cuda:" + str(k % ndevices)))
-            for k in range(self.ntables)
-        ]
-        lS_i = [
-            lS_i[k].to(torch.device("cuda:" + str(k % ndevices)))
-            for k in range(self.ntables)
-        ]
+        lS_o = self.scatter_sparse_features(lS_o, ndevices)
+        lS_i = self.scatter_sparse_features(lS_i, ndevices)
 
         ### compute results in parallel ###
         # bottom mlp
@@ -1101,15 +1561,32 @@ class DLRM_Net(nn.Module):
         if self.ntables != len(ly):
             sys.exit("ERROR: corrupted intermediate result in parallel_forward call")
 
-        t_list = [scatter(ly[k], device_ids, dim=0) for k in range(self.ntables)]
+        if all(y.shape[1] == ly[0].shape[1] for y in ly):
+            # stack the outputs of the tables placed on each device and scatter
+            # them with one call per device, instead of one call per table
+            shards = [
+                scatter(torch.stack(ly[d::ndevices]), device_ids, dim=1)
+                for d in device_ids
+            ]
+            # adjust the list to be ordered per device
+            ly = [
+                [shards[k % ndevices][j][k // ndevices] for k in range(self.ntables)]
+                for j in device_ids
+            ]
+        else:
+            t_list = [scatter(ly[k], device_ids, dim=0) for k in range(self.ntables)]
 
-        # adjust the list to be ordered per device
-        ly = list(map(lambda y: list(y), zip(*t_list)))
+            # adjust the list to be ordered per device
+            ly = list(map(lambda y: list(y), zip(*t_list)))
         # debug prints
         # print(ly)
 
         # interactions
-        z = parallel_apply(self.interact_features_l, list(zip(itertools.repeat(self.interact_features),x,ly)))
+        # (parallel_apply only calls its "modules", so the bound method is run
+        # directly on each device)
+        z = parallel_apply(
+            [self.interact_features] * ndevices, list(zip(x, ly)), None, device_ids
+        )
         # debug prints
         # print(z)
 
@@ -1166,32 +1643,41 @@ class DLRM_Net(nn.Module):
             print(param.detach().cpu().numpy())
 
 
+# whole-string patterns of dash separated lists of ints and (plain or
+# scientific notation) floats, each validated in one match
+dash_separated_ints_re = re.compile(r"\s*[+]?\d+\s*(?:-\s*[+]?\d+\s*)*")
+dash_separated_floats_re = re.compile(
+    r"\s*[+]?(?:\d+\.?\d*|\.\d+)(?:[eE][+]?\d+)?\s*"
+    r"(?:-\s*[+]?(?:\d+\.?\d*|\.\d+)(?:[eE][+]?\d+)?\s*)*"
+)
+
+
 def dash_separated_ints(value):
-    vals = value.split("-")
-    for val in vals:
-        try:
-            int(val)
-        except ValueError:
-            raise argparse.ArgumentTypeError(
-                "%s is not a valid dash separated list of ints" % value
-            )
+    if not dash_separated_ints_re.fullmatch(value):
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid dash separated list of ints" % value
+        )
 
     return value
 
 
 def dash_separated_floats(value):
-    vals = value.split("-")
-    for val in vals:
-        try:
-            float(val)
-        except ValueError:
-            raise argparse.ArgumentTypeError(
-                "%s is not a valid dash separated list of floats" % value
-            )
+    if not dash_separated_floats_re.fullmatch(value):
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid dash separated list of floats" % value
+        )
 
     return value
 
 
+def mlperf_run_stop(status):
+    mlperf_logger.barrier()
+    mlperf_logger.log_end(
+        key=mlperf_logger.constants.RUN_STOP,
+        metadata={mlperf_logger.constants.STATUS: status},
+    )
+
+
 def inference(
     args,
     dlrm,
@@ -1235,49 +1721,67 @@ def inference(
             continue
 
         # forward pass
-        Z_test = dlrm_wrap(
-            X_test,
-            lS_o_test,
-            lS_i_test,
-            use_gpu,
-            device,
-            ndevices=ndevices,
-        )
+        # (without recording the graph for autograd; no_grad rather than
+        # inference_mode, because the index caches the model builds lazily
+        # are reused by training, which cannot save inference tensors)
+        with torch.no_grad():
+            Z_test = dlrm_wrap(
+                X_test,
+                lS_o_test,
+                lS_i_test,
+                use_gpu,
+                device,
+                ndevices=ndevices,
+            )
         ### gather the distributed results on each rank ###
-        # For some reason it requires explicit sync before all_gather call if
-        # tensor is on GPU memory
-        if Z_test.is_cuda:
-            torch.cuda.synchronize()
         (_, batch_split_lengths) = ext_dist.get_split_lengths(X_test.size(0))
         if ext_dist.my_size > 1:
+            # For some reason it requires explicit sync before all_gather call if
+            # tensor is on GPU memory
+            if Z_test.is_cuda:
+                torch.cuda.synchronize()
             Z_test = ext_dist.all_gather(Z_test, batch_split_lengths)
 
+        # NOTE: results stay on the device or are copied back without blocking,
+        # so the loop does not wait for every batch; the device is synchronized
+        # once after the loop, before the copied scores are read.
+        # (the scores are copied into pinned memory, a non_blocking copy into
+        # pageable memory would not be asynchronous)
         if args.mlperf_logging:
-            S_test = Z_test.detach().cpu().numpy()  # numpy array
-            T_test = T_test.detach().cpu().numpy()  # numpy array
-            scores.append(S_test)
+            if Z_test.is_cuda:
+                S_test = torch.empty(Z_test.shape, dtype=Z_test.dtype, pin_memory=True)
+                scores.append(S_test.copy_(Z_test, non_blocking=True))
+            else:
+                scores.append(Z_test)
             targets.append(T_test)
         else:
             with record_function("DLRM accuracy compute"):
                 # compute loss and accuracy
-                S_test = Z_test.detach().cpu().numpy()  # numpy array
-                T_test = T_test.detach().cpu().numpy()  # numpy array
+                T_test = T_test.to(Z_test.device, non_blocking=True)
 
                 mbs_test = T_test.shape[0]  # = mini_batch_size except last
-                A_test = np.sum((np.round(S_test, 0) == T_test).astype(np.uint8))
+                # (the scores are probabilities in [0, 1], so rounding them is a
+                # comparison with 0.5, done without a rounded float copy)
+                A_test = Z_test.gt(0.5).to(T_test.dtype).eq(T_test).sum()
 
                 test_accu += A_test
                 test_samp += mbs_test
 
         if i >= args.warmup_steps:
+            # (wait for the batch when its latency is logged, otherwise only the
+            # time to queue its kernels would be measured)
+            if args.fb5logger is not None and use_gpu:
+                torch.cuda.synchronize()
             bmlogger.batch_stop()
 
+    if use_gpu:
+        torch.cuda.synchronize()
     bmlogger.run_stop(nbatches - args.warmup_steps, args.mini_batch_size)
 
     if args.mlperf_logging:
         with record_function("DLRM mlperf sklearn metrics compute"):
-            scores = np.concatenate(scores, axis=0)
-            targets = np.concatenate(targets, axis=0)
+            scores = torch.cat(scores, dim=0).numpy()
+            targets = torch.cat(targets, dim=0).cpu().numpy()
 
             metrics = {
                 "recall": lambda y_true, y_score: sklearn.metrics.recall_score(
@@ -1306,7 +1810,7 @@ def inference(
             )
         acc_test = validation_results["accuracy"]
     else:
-        acc_test = test_accu / test_samp
+        acc_test = int(test_accu) / test_samp
         writer.add_scalar("Test/Acc", acc_test, log_iter)
 
     model_metrics_dict = {
@@ -1414,6 +1918,9 @@ def run():
     parser.add_argument("--num-indices-per-lookup", type=int, default=10)
     parser.add_argument("--num-indices-per-lookup-fixed", type=bool, default=False)
     parser.add_argument("--num-workers", type=int, default=0)
+    # batches loaded in advance by each worker (with --num-workers > 0); large
+    # values mostly add pinned host memory
+    parser.add_argument("--prefetch-factor", type=int, default=2)
     parser.add_argument("--memory-map", action="store_true", default=False)
     # training
     parser.add_argument("--mini-batch-size", type=int, default=1)
@@ -1437,8 +1944,19 @@ def run():
     # quantize
     parser.add_argument("--quantize-mlp-with-bit", type=int, default=32)
     parser.add_argument("--quantize-emb-with-bit", type=int, default=32)
+    # torchao scheme for --quantize-mlp-with-bit=8: int8 weights only, int8
+    # weights and dynamically quantized int8 activations, or fp8 weights and
+    # activations (gpus with fp8 tensor cores only); required for 8-bit mlps on
+    # the gpu, without it the cpu path of PyTorch's dynamic quantization is used
+    parser.add_argument(
+        "--torchao-mlp-quant",
+        type=str,
+        choices=["int8wo", "int8dq", "fp8dq"],
+        default=None,
+    )
     # onnx
     parser.add_argument("--save-onnx", action="store_true", default=False)
+    parser.add_argument("--check-onnx", action="store_true", default=False)
     # gpu
     parser.add_argument("--use-gpu", action="store_true", default=False)
     parser.add_argument("--use-fbgemm-gpu", action="store_true", default=False)
@@ -1446,12 +1964,22 @@ def run():
         "--fbgemm-gpu-codegen-pref",
         type=str,
         choices=["Split", "IntN"],
-        default="Split",
+        default=None,  # IntN for --inference-only, Split otherwise
     )
     # torch2trt
     parser.add_argument("--use-torch2trt-for-mlp", action="store_true", default=False)
     #tf32
     parser.add_argument("--use-tf32", action="store_true", default=False)
+    # mixed precision training: the forward pass (mlps and interaction) runs under
+    # autocast in bf16 or fp16 (fp16 with a gradient scaler), the loss in fp32
+    parser.add_argument(
+        "--amp-dtype", type=str, choices=["bf16", "fp16"], default=None
+    )
+    # torch.compile
+    parser.add_argument("--use-torch-compile-for-mlp", action="store_true", default=False)
+    parser.add_argument(
+        "--use-torch-compile-for-interaction", action="store_true", default=False
+    )
     # distributed
     parser.add_argument("--local_rank", type=int, default=-1)
     parser.add_argument("--dist-backend", type=str, default="")
@@ -1515,16 +2043,16 @@ def run():
             sys.exit("ERROR: quotient remainder with weighted pooling is not supported")
         if args.md_flag:
             sys.exit("ERROR: mixed dimensions with weighted pooling is not supported")
-    if args.quantize_emb_with_bit in [4, 8]:
+    if args.quantize_emb_with_bit in [2, 4, 8]:
         if args.qr_flag:
             sys.exit(
-                "ERROR: 4 and 8-bit quantization with quotient remainder is not supported"
+                "ERROR: 2, 4 and 8-bit quantization with quotient remainder is not supported"
             )
         if args.md_flag:
             sys.exit(
-                "ERROR: 4 and 8-bit quantization with mixed dimensions is not supported"
+                "ERROR: 2, 4 and 8-bit quantization with mixed dimensions is not supported"
             )
-    if args.quantize_emb_with_bit in [4, 8, 16] and (
+    if args.quantize_emb_with_bit in [2, 4, 8, 16] and (
         not fbgemm_gpu or not args.use_fbgemm_gpu
     ):
         extra_info = ""
@@ -1548,11 +2076,12 @@ def run():
             )
 
     assert args.quantize_emb_with_bit in [
+        2,
         4,
         8,
         16,
         32,
-    ], "only support 4/8/16/32-bit but got {}".format(args.quantize_emb_with_bit)
+    ], "only support 2/4/8/16/32-bit but got {}".format(args.quantize_emb_with_bit)
 
     if args.use_gpu:
         assert torch.cuda.is_available(), "No cuda device is available."
@@ -1560,6 +2089,14 @@ def run():
         assert fbgemm_gpu, ("\nfbgemm_gpu module failed to import.\n\n" + fbgemm_gpu_import_error_msg)
     use_gpu = args.use_gpu
     use_fbgemm_gpu = args.use_fbgemm_gpu
+    if args.amp_dtype is not None and (not use_gpu or args.inference_only):
+        sys.exit(
+            "ERROR: --amp-dtype requires --use-gpu and training (no --inference-only)"
+        )
+    if args.fbgemm_gpu_codegen_pref is None:
+        # quantized inference defaults to the IntN kernels, which read the
+        # row-wise quantized tables directly
+        args.fbgemm_gpu_codegen_pref = "IntN" if args.inference_only else "Split"
 
     ### some basic setup ###
     np.random.seed(args.numpy_rand_seed)
@@ -1573,6 +2110,8 @@ def run():
     if args.test_num_workers < 0:
         # if the parameter is not set, use the same parameter for training
         args.test_num_workers = args.num_workers
+    if args.prefetch_factor < 1:
+        sys.exit("ERROR: --prefetch-factor must be at least 1")
 
     if not args.debug_mode:
         ext_dist.init_distributed(
@@ -1594,7 +2133,7 @@ def run():
         print("Using CPU...")
 
     ### prepare training data ###
-    ln_bot = np.fromstring(args.arch_mlp_bot, dtype=int, sep="-")
+    ln_bot = np.asarray(args.arch_mlp_bot.split("-"), dtype=int)
     # input data
 
     if args.mlperf_logging:
@@ -1605,32 +2144,26 @@ def run():
         mlperf_logger.barrier()
 
     if args.data_generation == "dataset":
-        train_data, train_ld, test_data, test_ld = dp.make_criteo_data_and_loaders(args)
+        # (batches are only pinned for asynchronous copies to the gpu)
+        train_data, train_ld, test_data, test_ld = dp.make_criteo_data_and_loaders(
+            args, pin_memory=use_gpu, prefetch_factor=args.prefetch_factor
+        )
         table_feature_map = {idx: idx for idx in range(len(train_data.counts))}
         nbatches = args.num_batches if args.num_batches > 0 else len(train_ld)
         nbatches_test = len(test_ld)
 
-        ln_emb = train_data.counts
+        ln_emb = np.array(train_data.counts)
         # enforce maximum limit on number of vectors per embedding
         if args.max_ind_range > 0:
-            ln_emb = np.array(
-                list(
-                    map(
-                        lambda x: x if x < args.max_ind_range else args.max_ind_range,
-                        ln_emb,
-                    )
-                )
-            )
-        else:
-            ln_emb = np.array(ln_emb)
+            ln_emb = np.minimum(ln_emb, args.max_ind_range)
         m_den = train_data.m_den
         ln_bot[0] = m_den
     else:
         # input and target at random
-        ln_emb = np.fromstring(args.arch_embedding_size, dtype=int, sep="-")
+        ln_emb = np.asarray(args.arch_embedding_size.split("-"), dtype=int)
         m_den = ln_bot[0]
         train_data, train_ld, test_data, test_ld = dp.make_random_data_and_loader(
-            args, ln_emb, m_den, cache_size=args.precache_ml_data
+            args, ln_emb, m_den, cache_size=args.precache_ml_data, pin_memory=use_gpu
         )
         nbatches = args.num_batches if args.num_batches > 0 else len(train_ld)
         nbatches_test = len(test_ld)
@@ -1673,8 +2206,8 @@ def run():
             + args.arch_interaction_op
             + " is not supported"
         )
-    arch_mlp_top_adjusted = str(num_int) + "-" + args.arch_mlp_top
-    ln_top = np.fromstring(arch_mlp_top_adjusted, dtype=int, sep="-")
+    # the top mlp input is the interaction output
+    ln_top = np.asarray([num_int] + args.arch_mlp_top.split("-"), dtype=int)
 
     # sanity check: feature sizes and mlp dimensions must match
     if m_den != ln_bot[0]:
@@ -1776,14 +2309,14 @@ def run():
             print(X.detach().cpu())
             # transform offsets to lengths when printing
             print(
-                torch.IntTensor(
+                torch.stack(
                     [
-                        np.diff(
-                            S_o.detach().cpu().tolist() + list(lS_i[i].shape)
-                        ).tolist()
+                        torch.diff(
+                            S_o.detach().cpu(), append=torch.tensor(lS_i[i].shape)
+                        )
                         for i, S_o in enumerate(lS_o)
                     ]
-                )
+                ).int()
             )
             print([S_i.detach().cpu() for S_i in lS_i])
             print(T.detach().cpu())
@@ -1826,6 +2359,13 @@ def run():
         quantize_emb_with_bit=args.quantize_emb_with_bit,
         use_torch2trt_for_mlp=args.use_torch2trt_for_mlp,
         use_tf32=args.use_tf32,
+        use_torch_compile_for_interaction=args.use_torch_compile_for_interaction,
+        # criteo samples and random data with one index per lookup have
+        # exactly one sparse index per table
+        unit_pooling=(
+            args.data_generation == "dataset"
+            or (args.data_generation == "random" and args.num_indices_per_lookup == 1)
+        ),
     )
 
     # test prints
@@ -1858,18 +2398,41 @@ def run():
             if args.quantize_mlp_with_bit == 16 and use_gpu:
                 dlrm.top_l = dlrm.top_l.half()
                 dlrm.bot_l = dlrm.bot_l.half()
+            elif args.quantize_mlp_with_bit == 8 and args.torchao_mlp_quant:
+                if torchao is None:
+                    sys.exit("\ntorchao module failed to import.\n\n" + torchao_import_error_msg)
+                if args.torchao_mlp_quant == "fp8dq" and not use_gpu:
+                    sys.exit("ERROR: --torchao-mlp-quant=fp8dq requires --use-gpu")
+                # the dynamic schemes also run the gemms in int8/fp8, which pays
+                # off for the compute-bound mlps of large batches
+                torchao_mlp_config = {
+                    "int8wo": Int8WeightOnlyConfig,
+                    "int8dq": Int8DynamicActivationInt8WeightConfig,
+                    "fp8dq": Float8DynamicActivationFloat8WeightConfig,
+                }[args.torchao_mlp_quant]
+                quantize_(dlrm.top_l, torchao_mlp_config())
+                quantize_(dlrm.bot_l, torchao_mlp_config())
             elif args.quantize_mlp_with_bit in [8, 16]:
                 assert not use_gpu, (
                     "Cannot run PyTorch's built-in dynamic quantization for mlp "
                     + "with --use-gpu enabled, because DynamicQuantizedLinear's "
                     + "forward function calls 'quantized::linear_dynamic', which does not "
-                    + "support the 'CUDA' backend. To convert to and run quantized mlp layers "
+                    + "support the 'CUDA' backend. To convert to and run 8-bit mlp layers "
+                    + "on the gpu, install torchao and set --torchao-mlp-quant (int8wo "
+                    + "keeps int8 weights only). To convert to and run quantized mlp layers "
                     + "on the gpu, install torch2trt and enable --use-torch2trt-for-mlp. "
                     + "Alternatively, disable --use-gpu to use PyTorch's built-in "
                     + "cpu quantization ops for the mlp layers. "
                 )
                 if args.quantize_mlp_with_bit == 8:
                     quantize_dtype = torch.qint8
+                    # run the int8 linears on FBGEMM's AVX2/AVX-512 (VNNI) gemms;
+                    # the x86 engine already dispatches them to FBGEMM
+                    if (
+                        torch.backends.quantized.engine not in ["fbgemm", "x86"]
+                        and "fbgemm" in torch.backends.quantized.supported_engines
+                    ):
+                        torch.backends.quantized.engine = "fbgemm"
                 else:
                     quantize_dtype = torch.float16
                 dlrm.top_l = torch.quantization.quantize_dynamic(
@@ -1879,6 +2442,11 @@ def run():
                     dlrm.bot_l, {torch.nn.Linear}, quantize_dtype
                 )
 
+    # Keep the wbce loss weights on the device of the targets, so the weight
+    # gather in loss_fn_wrap does not need a copy per iteration.
+    if dlrm.loss_function == "wbce":
+        dlrm.loss_ws = dlrm.loss_ws.to(device)
+
     # Prep work for embedding tables and model transfer:
     # Handling single-cpu and single-gpu modes
     # NOTE: This also handles dist-backend modes (CLI args --dist-backend=nccl,
@@ -1937,6 +2505,42 @@ def run():
             error_msg = error_msg[:-2] + "."
             sys.exit(error_msg)
 
+    if args.use_torch_compile_for_mlp:
+        # Compile the mlps in place, so that Inductor fuses each Linear with its
+        # activation, while the state_dict keys stay unchanged for load/save.
+        # CUDA graphs (reduce-overhead) are only used for inference, where the
+        # weights are not updated between replays.
+        # Quantized mlps (dynamic quantization or torchao) are not compiled.
+        if (
+            not args.use_torch2trt_for_mlp
+            and dlrm.ndevices_available <= 1
+            and args.quantize_mlp_with_bit == 32
+        ):
+            compile_mode = "reduce-overhead" if args.inference_only else None
+            if hasattr(nn.Module, "compile"):
+                dlrm.bot_l.compile(mode=compile_mode, dynamic=False)
+                dlrm.top_l.compile(mode=compile_mode, dynamic=False)
+            elif hasattr(torch, "compile"):
+                # (before Module.compile, the compiled wrapper prefixes the
+                # state_dict keys of the mlps with _orig_mod)
+                dlrm.bot_l = torch.compile(dlrm.bot_l, mode=compile_mode, dynamic=False)
+                dlrm.top_l = torch.compile(dlrm.top_l, mode=compile_mode, dynamic=False)
+            else:
+                # PyTorch builds without torch.compile still fuse the pointwise
+                # ops of the scripted mlps
+                dlrm.bot_l = torch.jit.script(dlrm.bot_l)
+                dlrm.top_l = torch.jit.script(dlrm.top_l)
+        else:
+            error_msg = "ERROR: When --use-torch-compile-for-mlp is enabled, "
+            if args.use_torch2trt_for_mlp:
+                error_msg += "--use-torch2trt-for-mlp must be disabled, "
+            if dlrm.ndevices_available > 1:
+                error_msg += "at most one gpu per process must be used, "
+            if args.quantize_mlp_with_bit != 32:
+                error_msg += "--quantize-mlp-with-bit must be 32, "
+            error_msg = error_msg[:-2] + "."
+            sys.exit(error_msg)
+
     # distribute data parallel mlps
     if ext_dist.my_size > 1:
         if use_gpu:
@@ -1960,33 +2564,7 @@ def run():
         parameters = (
             dlrm.parameters()
             if ext_dist.my_size == 1
-            else [
-                {
-                    "params": [
-                        p
-                        for emb in (
-                            [e.fbgemm_gpu_emb_bag for e in dlrm.fbgemm_emb_l]
-                            if use_fbgemm_gpu
-                            else dlrm.emb_l_q
-                            if dlrm.quantize_bits != 32
-                            else dlrm.emb_l
-                        )
-                        for p in emb.parameters()
-                    ],
-                    "lr": args.learning_rate,
-                },
-                # TODO check this lr setup
-                # bottom mlp has no data parallelism
-                # need to check how do we deal with top mlp
-                {
-                    "params": dlrm.bot_l.parameters(),
-                    "lr": args.learning_rate,
-                },
-                {
-                    "params": dlrm.top_l.parameters(),
-                    "lr": args.learning_rate,
-                },
-            ]
+            else build_param_groups(dlrm, args.learning_rate, use_fbgemm_gpu)
         )
         optimizer = opts[args.optimizer](parameters, lr=args.learning_rate)
         lr_scheduler = LRPolicyScheduler(
@@ -2106,12 +2684,35 @@ def run():
         mlperf_logger.log_event(key="sgd_opt_learning_rate_decay_poly_power", value=2)
 
     tb_file = "./" + args.tensor_board_filename
-    writer = SummaryWriter(tb_file)
+    # (events are buffered and only written by the flush at each epoch end)
+    writer = SummaryWriter(tb_file, max_queue=10**6, flush_secs=10**9)
+
+    # checkpoints are written by a background thread, one at a time
+    checkpoint_executor = None
+    checkpoint_future = None
 
     # Pre-cache samples.
     if args.precache_ml_data:
-        for _ in (test_ld if args.inference_only else train_ld):
-            pass
+        if args.data_generation == "dataset":
+            for _ in (test_ld if args.inference_only else train_ld):
+                pass
+        else:
+            # Only the first precache_ml_data batches are distinct (the cache key
+            # is the batch index modulo the cache size), so generate just those,
+            # indexing the dataset directly rather than collating and pinning
+            # every batch of the loader.
+            precache_data = test_data if args.inference_only else train_data
+            nprecache = min(args.precache_ml_data, len(precache_data))
+            for i in range(nprecache):
+                precache_data[i]
+            # (a short last batch is cached under its own size, so it is distinct
+            # too; it is generated last, as in a full pass over the loader)
+            last = len(precache_data) - 1
+            if (
+                last >= nprecache
+                and precache_data.data_size % precache_data.mini_batch_size != 0
+            ):
+                precache_data[last]
 
     ext_dist.barrier()
     with torch.autograd.profiler.profile(
@@ -2125,9 +2726,57 @@ def run():
                 bmlogger = get_bmlogger(args.fb5logger)
                 bmlogger.header("DLRM", "OOTB", "train", args.fb5config, score_metric=loggerconstants.EXPS)
 
-            k = 0
-            while k < args.nepochs:
-                if args.mlperf_logging:
+            amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(
+                args.amp_dtype
+            )
+            # fp16 gradients are scaled to not underflow, bf16 has the range of fp32
+            if args.amp_dtype == "fp16":
+                grad_scaler = torch.cuda.amp.GradScaler()
+            else:
+                grad_scaler = None
+
+            # whether the last param group holds the lazily created parameters
+            lazy_params_added = False
+
+            # (dlrm_wrap copies the batch to the device in single-gpu runs, so the
+            # copy of the next batch can be started early on a side stream)
+            # (the batches the loop below skips are not copied)
+            if use_gpu and ndevices == 1:
+                train_iter = DLRMPrefetcher(
+                    train_ld,
+                    device,
+                    nbatches,
+                    lambda j, b: j < skip_upto_batch
+                    or (
+                        ext_dist.my_size > 1
+                        and unpack_batch(b)[0].size(0) % ext_dist.my_size != 0
+                    ),
+                )
+            else:
+                train_iter = train_ld
+
+            # (checked several times per iteration, keep them in locals)
+            mlperf_logging = args.mlperf_logging
+            mlperf_acc_threshold = args.mlperf_acc_threshold
+            mlperf_auc_threshold = args.mlperf_auc_threshold
+            train_ld_len = len(train_ld)
+
+            # batches after which the model is tested, the same in every epoch
+            test_schedule = np.zeros(nbatches, dtype=bool)
+            if (
+                nbatches > 0
+                and args.test_freq > 0
+                and args.data_generation in ["dataset", "random"]
+            ):
+                test_schedule[args.test_freq - 1 :: args.test_freq] = True
+                test_schedule[-1] = True
+            test_schedule = test_schedule.tolist()
+
+            stop_training = False
+            for k in range(args.nepochs):
+                if mlperf_logging:
+                    # (log calls are rank 0 only, so a single barrier per
+                    # epoch is enough to keep the ranks in step)
                     mlperf_logger.barrier()
                     mlperf_logger.log_start(
                         key=mlperf_logger.constants.BLOCK_START,
@@ -2136,7 +2785,6 @@ def run():
                             mlperf_logger.constants.EPOCH_COUNT: 1,
                         },
                     )
-                    mlperf_logger.barrier()
                     mlperf_logger.log_start(
                         key=mlperf_logger.constants.EPOCH_START,
                         metadata={mlperf_logger.constants.EPOCH_NUM: (k + 1)},
@@ -2148,10 +2796,15 @@ def run():
                 if args.print_accumulated_time:
                     accum_time_begin = time_wrap(use_gpu)
 
-                if args.mlperf_logging:
+                if mlperf_logging:
                     previous_iteration_time = None
 
-                for j, inputBatch in enumerate(train_ld):
+                for j, inputBatch in enumerate(train_iter):
+                    # early exit if nbatches was set by the user and has been exceeded
+                    # (checked first, so no work is done for the extra batch)
+                    if nbatches > 0 and j >= nbatches:
+                        break
+
                     if j == 0 and args.save_onnx:
                         X_onnx, lS_o_onnx, lS_i_onnx, _, _, _ = unpack_batch(inputBatch)
 
@@ -2163,7 +2816,7 @@ def run():
 
                     X, lS_o, lS_i, T, W, CBPP = unpack_batch(inputBatch)
 
-                    if args.mlperf_logging:
+                    if mlperf_logging:
                         current_time = time_wrap(use_gpu)
                         if previous_iteration_time:
                             iteration_time = current_time - previous_iteration_time
@@ -2173,10 +2826,6 @@ def run():
                     else:
                         t1 = time_wrap(use_gpu)
 
-                    # early exit if nbatches was set by the user and has been exceeded
-                    if nbatches > 0 and j >= nbatches:
-                        break
-
                     # Skip the batch if batch size not multiple of total ranks
                     if ext_dist.my_size > 1 and X.size(0) % ext_dist.my_size != 0:
                         print(
@@ -2188,24 +2837,31 @@ def run():
                     mbs = T.shape[0]  # = args.mini_batch_size except maybe for last
 
                     # forward pass
-                    Z = dlrm_wrap(
-                        X,
-                        lS_o,
-                        lS_i,
-                        use_gpu,
-                        device,
-                        ndevices=ndevices,
-                    )
+                    with torch.autocast(
+                        "cuda", dtype=amp_dtype, enabled=amp_dtype is not None
+                    ):
+                        Z = dlrm_wrap(
+                            X,
+                            lS_o,
+                            lS_i,
+                            use_gpu,
+                            device,
+                            ndevices=ndevices,
+                        )
+                    if amp_dtype is not None:
+                        # (BCELoss is unsafe to autocast)
+                        Z = Z.float()
 
                     if ext_dist.my_size > 1:
                         T = T[ext_dist.get_my_slice(mbs)]
-                        W = W[ext_dist.get_my_slice(mbs)]
+                        if W is not None:
+                            W = W[ext_dist.get_my_slice(mbs)]
 
                     # loss
                     E = loss_fn_wrap(Z, T, use_gpu, device)
 
                     # compute loss and accuracy
-                    L = E.detach().cpu().numpy()  # numpy array
+                    # (the loss is accumulated on the device, see total_loss below)
                     # training accuracy is not disabled
                     # S = Z.detach().cpu().numpy()  # numpy array
                     # T = T.detach().cpu().numpy()  # numpy array
@@ -2226,33 +2882,18 @@ def run():
                             # self.parallel_model_is_not_prepared is set back to True
                             # when self.parallel_model_batch_size != batch_size.
                             # Search "self.parallel_model_batch_size != batch_size" in code.
-                            if "lazy_params" in optimizer.param_groups[-1].keys():
+                            if lazy_params_added:
                                 optimizer.param_groups.pop()
 
-                            # dlrm.v_W_l_l is a list of nn.ParameterLists, one ParameterList per gpu.
-                            # Flatten the list of nn.ParameterList to one nn.ParameterList,
-                            # and add it to the trainable params list.
-                            lazy_params = nn.ParameterList()
-                            if dlrm.weighted_pooling == "learned":
-                                lazy_params.extend(
-                                    nn.ParameterList(
-                                        [p for p_l in dlrm.v_W_l_l for p in p_l]
-                                    )
-                                )
-                            if dlrm.use_fbgemm_gpu:
-                                lazy_params.extend(
-                                    nn.ParameterList(
-                                        [
-                                            emb
-                                            for emb_ in dlrm.fbgemm_emb_l
-                                            for emb in emb_.fbgemm_gpu_emb_bag.parameters()
-                                        ]
-                                    )
-                                )
-                            lazy_params_dict = optimizer.param_groups[0]
+                            # dlrm.lazy_params is the flat list of the parameters created
+                            # by prepare_parallel_model, added to the trainable params in a
+                            # new group with the settings of the first group.
+                            # (a copy, so the first group keeps its own params)
+                            lazy_params_dict = dict(optimizer.param_groups[0])
                             lazy_params_dict["lazy_params"] = True
-                            lazy_params_dict["params"] = lazy_params
+                            lazy_params_dict["params"] = dlrm.lazy_params
                             optimizer.param_groups.append(lazy_params_dict)
+                            lazy_params_added = True
                             dlrm.add_new_weights_to_params = False
                             # Run "[[t.device.type for t in grp['params']] for grp in optimizer.param_groups]"
                             # to view devices used by tensors in the param groups.
@@ -2260,47 +2901,58 @@ def run():
                         # scaled error gradient propagation
                         # (where we do not accumulate gradients across mini-batches)
                         if (
-                            args.mlperf_logging
+                            mlperf_logging
                             and (j + 1) % args.mlperf_grad_accum_iter == 0
-                        ) or not args.mlperf_logging:
+                        ) or not mlperf_logging:
                             optimizer.zero_grad()
                         # backward pass
-                        E.backward()
+                        if grad_scaler is not None:
+                            grad_scaler.scale(E).backward()
+                        else:
+                            E.backward()
 
                         # optimizer
                         if (
-                            args.mlperf_logging
+                            mlperf_logging
                             and (j + 1) % args.mlperf_grad_accum_iter == 0
-                        ) or not args.mlperf_logging:
-                            optimizer.step()
+                        ) or not mlperf_logging:
+                            if grad_scaler is not None:
+                                grad_scaler.step(optimizer)
+                                grad_scaler.update()
+                            else:
+                                optimizer.step()
                             lr_scheduler.step()
 
-                    if args.mlperf_logging:
+                    if mlperf_logging:
                         total_time += iteration_time
                     else:
                         t2 = time_wrap(use_gpu)
                         total_time += t2 - t1
 
-                    total_loss += L * mbs
+                    # accumulate on the device of the loss, instead of copying it to
+                    # the host (and waiting for the step) every iteration
+                    # (in place, with the scaling fused into the add)
+                    if torch.is_tensor(total_loss):
+                        total_loss.add_(E.detach(), alpha=mbs)
+                    else:
+                        total_loss = E.detach() * mbs + total_loss
                     total_iter += 1
                     total_samp += mbs
 
                     should_print = ((j + 1) % args.print_freq == 0) or (
                         j + 1 == nbatches
                     )
-                    should_test = (
-                        (args.test_freq > 0)
-                        and (args.data_generation in ["dataset", "random"])
-                        and (((j + 1) % args.test_freq == 0) or (j + 1 == nbatches))
-                    )
+                    should_test = test_schedule[j]
 
                     # print time, loss and accuracy
                     if should_print or should_test:
                         gT = 1000.0 * total_time / total_iter if args.print_time else -1
                         total_time = 0
 
-                        train_loss = total_loss / total_samp
-                        total_loss = 0
+                        train_loss = float(total_loss) / total_samp
+                        # (reset in place, so the accumulator is allocated once)
+                        if torch.is_tensor(total_loss):
+                            total_loss.zero_()
 
                         str_run_type = (
                             "inference" if args.inference_only else "training"
@@ -2338,9 +2990,8 @@ def run():
 
                     # testing
                     if should_test:
-                        epoch_num_float = (j + 1) / len(train_ld) + k + 1
-                        if args.mlperf_logging:
-                            mlperf_logger.barrier()
+                        epoch_num_float = (j + 1) / train_ld_len + k + 1
+                        if mlperf_logging:
                             mlperf_logger.log_start(
                                 key=mlperf_logger.constants.EVAL_START,
                                 metadata={
@@ -2349,7 +3000,7 @@ def run():
                             )
 
                         # don't measure training iter time in a test iteration
-                        if args.mlperf_logging:
+                        if mlperf_logging:
                             previous_iteration_time = None
                         print(
                             "Testing at - {}/{} of epoch {},".format(j + 1, nbatches, k)
@@ -2370,18 +3021,37 @@ def run():
                             and not (args.save_model == "")
                             and not args.inference_only
                         ):
-                            model_metrics_dict["epoch"] = k
-                            model_metrics_dict["iter"] = j + 1
-                            model_metrics_dict["train_loss"] = train_loss
-                            model_metrics_dict["total_loss"] = total_loss
-                            model_metrics_dict[
-                                "opt_state_dict"
-                            ] = optimizer.state_dict()
+                            to_save = {
+                                **model_metrics_dict,
+                                "epoch": k,
+                                "iter": j + 1,
+                                "train_loss": train_loss,
+                                "total_loss": float(total_loss),
+                                "opt_state_dict": optimizer.state_dict(),
+                            }
                             print("Saving model to {}".format(args.save_model))
-                            torch.save(model_metrics_dict, args.save_model)
+                            if checkpoint_executor is None:
+                                checkpoint_executor = (
+                                    concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                                )
+                            # wait for the previous save (and raise its errors), so
+                            # at most one staged copy is kept in host memory
+                            if checkpoint_future is not None:
+                                checkpoint_future.result()
+                            to_save = stage_checkpoint(to_save)
+                            if use_gpu:
+                                torch.cuda.synchronize()
+                            # (zipfile format keeps tensor data out of the pickle
+                            # stream, protocol 4 frames the remaining metadata)
+                            checkpoint_future = checkpoint_executor.submit(
+                                torch.save,
+                                to_save,
+                                args.save_model,
+                                _use_new_zipfile_serialization=True,
+                                pickle_protocol=4,
+                            )
 
-                        if args.mlperf_logging:
-                            mlperf_logger.barrier()
+                        if mlperf_logging:
                             mlperf_logger.log_end(
                                 key=mlperf_logger.constants.EVAL_STOP,
                                 metadata={
@@ -2394,59 +3064,51 @@ def run():
                         # .format(time_wrap(use_gpu) - accum_test_time_begin))
 
                         if (
-                            args.mlperf_logging
-                            and (args.mlperf_acc_threshold > 0)
-                            and (best_acc_test > args.mlperf_acc_threshold)
+                            mlperf_logging
+                            and (mlperf_acc_threshold > 0)
+                            and (best_acc_test > mlperf_acc_threshold)
                         ):
                             print(
                                 "MLPerf testing accuracy threshold "
-                                + str(args.mlperf_acc_threshold)
+                                + str(mlperf_acc_threshold)
                                 + " reached, stop training"
                             )
+                            stop_training = True
                             break
 
                         if (
-                            args.mlperf_logging
-                            and (args.mlperf_auc_threshold > 0)
-                            and (best_auc_test > args.mlperf_auc_threshold)
+                            mlperf_logging
+                            and (mlperf_auc_threshold > 0)
+                            and (best_auc_test > mlperf_auc_threshold)
                         ):
                             print(
                                 "MLPerf testing auc threshold "
-                                + str(args.mlperf_auc_threshold)
+                                + str(mlperf_auc_threshold)
                                 + " reached, stop training"
                             )
-                            if args.mlperf_logging:
-                                mlperf_logger.barrier()
-                                mlperf_logger.log_end(
-                                    key=mlperf_logger.constants.RUN_STOP,
-                                    metadata={
-                                        mlperf_logger.constants.STATUS: mlperf_logger.constants.SUCCESS
-                                    },
-                                )
+                            stop_training = True
                             break
                 if k == 0:
                     bmlogger.run_stop(nbatches - args.warmup_steps, args.mini_batch_size)
 
-                if args.mlperf_logging:
-                    mlperf_logger.barrier()
+                if mlperf_logging:
                     mlperf_logger.log_end(
                         key=mlperf_logger.constants.EPOCH_STOP,
                         metadata={mlperf_logger.constants.EPOCH_NUM: (k + 1)},
                     )
-                    mlperf_logger.barrier()
                     mlperf_logger.log_end(
                         key=mlperf_logger.constants.BLOCK_STOP,
                         metadata={mlperf_logger.constants.FIRST_EPOCH_NUM: (k + 1)},
                     )
-                k += 1  # nepochs
-            if args.mlperf_logging and best_auc_test <= args.mlperf_auc_threshold:
-                mlperf_logger.barrier()
-                mlperf_logger.log_end(
-                    key=mlperf_logger.constants.RUN_STOP,
-                    metadata={
-                        mlperf_logger.constants.STATUS: mlperf_logger.constants.ABORTED
-                    },
-                )
+                # write out the buffered tensorboard events once per epoch
+                writer.flush()
+                if stop_training:
+                    break
+            if mlperf_logging:
+                if 0 < mlperf_auc_threshold < best_auc_test:
+                    mlperf_run_stop(mlperf_logger.constants.SUCCESS)
+                elif best_auc_test <= mlperf_auc_threshold:
+                    mlperf_run_stop(mlperf_logger.constants.ABORTED)
         else:
             print("Testing for inference only")
             inference(
@@ -2461,7 +3123,7 @@ def run():
 
     # profiling
     if args.enable_profiling:
-        time_stamp = str(datetime.datetime.now()).replace(" ", "_")
+        time_stamp = time.strftime("%Y-%m-%d_%H-%M-%S")
         with open("dlrm_s_pytorch" + time_stamp + "_shape.prof", "w") as prof_f:
             prof_f.write(
                 prof.key_averages(group_by_input_shape=True).table(
@@ -2502,19 +3164,24 @@ def run():
         # print("inputs", X_onnx, lS_o_onnx, lS_i_onnx)
         # print("output", dlrm_wrap(X_onnx, lS_o_onnx, lS_i_onnx, use_gpu, device))
         dlrm_pytorch_onnx_file = "dlrm_s_pytorch.onnx"
-        print("X_onnx.shape", X_onnx.shape)
-        if torch.is_tensor(lS_o_onnx):
-            print("lS_o_onnx.shape", lS_o_onnx.shape)
-        else:
-            for oo in lS_o_onnx:
-                print("oo.shape", oo.shape)
-        if torch.is_tensor(lS_i_onnx):
-            print("lS_i_onnx.shape", lS_i_onnx.shape)
-        else:
-            for ii in lS_i_onnx:
-                print("ii.shape", ii.shape)
+        if args.debug_mode:
+            print("X_onnx.shape", X_onnx.shape)
+            if torch.is_tensor(lS_o_onnx):
+                print("lS_o_onnx.shape", lS_o_onnx.shape)
+            else:
+                for oo in lS_o_onnx:
+                    print("oo.shape", oo.shape)
+            if torch.is_tensor(lS_i_onnx):
+                print("lS_i_onnx.shape", lS_i_onnx.shape)
+            else:
+                for ii in lS_i_onnx:
+                    print("ii.shape", ii.shape)
 
         # name inputs and outputs
+        # (with unit pooling, the unquantized EmbeddingBag tables are looked up
+        # without their offsets, so the offsets inputs of those tables are
+        # ignored by the exported graph; they are kept so that the model takes
+        # the same inputs as DLRM_Net.forward whichever tables are pooled)
         o_inputs = (
             ["offsets"]
             if torch.is_tensor(lS_o_onnx)
@@ -2527,47 +3194,43 @@ def run():
         )
         all_inputs = ["dense_x"] + o_inputs + i_inputs
         # debug prints
-        print("inputs", all_inputs)
-
-        # create dynamic_axis dictionaries
-        do_inputs = (
-            [{"offsets": {1: "batch_size"}}]
-            if torch.is_tensor(lS_o_onnx)
-            else [
-                {"offsets_" + str(i): {0: "batch_size"}} for i in range(len(lS_o_onnx))
-            ]
-        )
-        di_inputs = (
-            [{"indices": {1: "batch_size"}}]
-            if torch.is_tensor(lS_i_onnx)
-            else [
-                {"indices_" + str(i): {0: "batch_size"}} for i in range(len(lS_i_onnx))
-            ]
-        )
-        dynamic_axes = {"dense_x": {0: "batch_size"}, "pred": {0: "batch_size"}}
-        for do in do_inputs:
-            dynamic_axes.update(do)
-        for di in di_inputs:
-            dynamic_axes.update(di)
+        if args.debug_mode:
+            print("inputs", all_inputs)
+
+        # create dynamic_axis dictionary
+        # (stacked offsets/indices tensors carry the batch in dim 1)
+        o_axis = 1 if torch.is_tensor(lS_o_onnx) else 0
+        i_axis = 1 if torch.is_tensor(lS_i_onnx) else 0
+        dynamic_axes = {
+            "dense_x": {0: "batch_size"},
+            "pred": {0: "batch_size"},
+            **{name: {o_axis: "batch_size"} for name in o_inputs},
+            **{name: {i_axis: "batch_size"} for name in i_inputs},
+        }
         # debug prints
-        print(dynamic_axes)
+        if args.debug_mode:
+            print(dynamic_axes)
         # export model
         torch.onnx.export(
             dlrm,
             (X_onnx, lS_o_onnx, lS_i_onnx),
             dlrm_pytorch_onnx_file,
-            verbose=True,
+            verbose=False,
             use_external_data_format=True,
             opset_version=11,
             input_names=all_inputs,
             output_names=["pred"],
             dynamic_axes=dynamic_axes,
         )
-        # recover the model back
-        dlrm_pytorch_onnx = onnx.load("dlrm_s_pytorch.onnx")
-        # check the onnx model
-        onnx.checker.check_model(dlrm_pytorch_onnx)
-    total_time_end = time_wrap(use_gpu)
+        if args.check_onnx:
+            # recover the model back
+            dlrm_pytorch_onnx = onnx.load("dlrm_s_pytorch.onnx")
+            # check the onnx model
+            onnx.checker.check_model(dlrm_pytorch_onnx)
+    if checkpoint_executor is not None:
+        checkpoint_executor.shutdown(wait=True)
+        checkpoint_future.result()
+    writer.close()
 
 
 if __name__ == "__main__":
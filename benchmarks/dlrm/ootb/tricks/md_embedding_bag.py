@@ -34,10 +34,10 @@ def md_solver(n, alpha, d0=None, B=None, round_dim=True, k=None):
     d = alpha_power_rule(n.type(torch.float) / k, alpha, d0=d0, B=B)
     if round_dim:
         d = pow_2_round(d)
-    undo_sort = [0] * len(indices)
-    for i, v in enumerate(indices):
-        undo_sort[v] = i
-    return d[undo_sort]
+    # undo the sort by scattering the dims back to the original positions
+    d_unsorted = torch.empty_like(d)
+    d_unsorted[indices] = d
+    return d_unsorted
 
 
 def alpha_power_rule(n, alpha, d0=None, B=None):
@@ -48,11 +48,9 @@ def alpha_power_rule(n, alpha, d0=None, B=None):
     else:
         raise ValueError("Must specify either d0 or B")
     d = torch.ones(len(n)) * lamb * (n.type(torch.float) ** (-alpha))
-    for i in range(len(d)):
-        if i == 0 and d0 is not None:
-            d[i] = d0
-        else:
-            d[i] = 1 if d[i] < 1 else d[i]
+    d = torch.clamp(d, min=1)
+    if d0 is not None:
+        d[0] = d0
     return (torch.round(d).type(torch.long))
 
 